@@ -329,7 +329,8 @@ class MultiScaleDeformableAttention(nn.Module):
     
         if torch.cuda.is_available() and value.is_cuda:
             halffloat = False
-            if value.dtype == torch.float16:
+            input_dtype = value.dtype
+            if value.dtype in (torch.float16, torch.bfloat16):
                 halffloat = True
                 value = value.float()
                 sampling_locations = sampling_locations.float()
@@ -345,7 +346,7 @@ class MultiScaleDeformableAttention(nn.Module):
             )
 
             if halffloat:
-                output = output.half()
+                output = output.to(input_dtype)
         else:
             output = multi_scale_deformable_attn_pytorch(
                 value, spatial_shapes, sampling_locations, attention_weights
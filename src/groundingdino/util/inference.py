@@ -10,7 +10,7 @@ import bisect
 
 from groundingdino.datasets import transforms as T
 from groundingdino.models import build_model
-from groundingdino.util.misc import clean_state_dict
+from groundingdino.util.misc import clean_state_dict, nested_tensor_from_tensor_list
 from groundingdino.util.slconfig import SLConfig
 from groundingdino.util.utils import get_phrases_from_posmap
 
@@ -70,13 +70,74 @@ def predict(
     prediction_logits = outputs["pred_logits"].cpu().sigmoid()[0]  # prediction_logits.shape = (nq, 256)
     prediction_boxes = outputs["pred_boxes"].cpu()[0]  # prediction_boxes.shape = (nq, 4)
 
+    tokenizer = model.tokenizer
+    tokenized = tokenizer(caption)
+
+    return _select_predictions(
+        prediction_logits=prediction_logits,
+        prediction_boxes=prediction_boxes,
+        tokenized=tokenized,
+        tokenizer=tokenizer,
+        box_threshold=box_threshold,
+        text_threshold=text_threshold,
+        remove_combined=remove_combined
+    )
+
+
+def predict_batch(
+        model,
+        images: List[torch.Tensor],
+        caption: str,
+        box_threshold: float,
+        text_threshold: float,
+        device: str = "cuda",
+        remove_combined: bool = False
+) -> Tuple[List[torch.Tensor], List[torch.Tensor], List[List[str]]]:
+    caption = preprocess_caption(caption=caption)
+
+    model = model.to(device)
+    samples = nested_tensor_from_tensor_list([image.to(device) for image in images])
+
+    with torch.no_grad():
+        outputs = model(samples, captions=[caption] * len(images))
+
+    prediction_logits = outputs["pred_logits"].cpu().sigmoid()  # prediction_logits.shape = (bs, nq, 256)
+    prediction_boxes = outputs["pred_boxes"].cpu()  # prediction_boxes.shape = (bs, nq, 4)
+
+    tokenizer = model.tokenizer
+    tokenized = tokenizer(caption)
+
+    boxes, logits, phrases = [], [], []
+    for image_logits, image_boxes in zip(prediction_logits, prediction_boxes):
+        image_boxes, image_logits, image_phrases = _select_predictions(
+            prediction_logits=image_logits,
+            prediction_boxes=image_boxes,
+            tokenized=tokenized,
+            tokenizer=tokenizer,
+            box_threshold=box_threshold,
+            text_threshold=text_threshold,
+            remove_combined=remove_combined
+        )
+        boxes.append(image_boxes)
+        logits.append(image_logits)
+        phrases.append(image_phrases)
+
+    return boxes, logits, phrases
+
+
+def _select_predictions(
+        prediction_logits: torch.Tensor,
+        prediction_boxes: torch.Tensor,
+        tokenized,
+        tokenizer,
+        box_threshold: float,
+        text_threshold: float,
+        remove_combined: bool = False
+) -> Tuple[torch.Tensor, torch.Tensor, List[str]]:
     mask = prediction_logits.max(dim=1)[0] > box_threshold
     logits = prediction_logits[mask]  # logits.shape = (n, 256)
     boxes = prediction_boxes[mask]  # boxes.shape = (n, 4)
 
-    tokenizer = model.tokenizer
-    tokenized = tokenizer(caption)
-    
     if remove_combined:
         sep_idx = [i for i in range(len(tokenized['input_ids'])) if tokenized['input_ids'][i] in [101, 102, 1012]]
         
@@ -1,29 +1,46 @@
 import os
+import copy
 os.environ['TORCH_CUDNN_SDPA_ENABLED'] = '1'  #Permtute usar las funciones especiales de SAM2 como el manejo eficiente de memoria y los bloques de atencion
 
 import torch
 import numpy as np
 from PIL import Image
-from typing import List, Union, Tuple, Optional 
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import ClassVar, List, Union, Tuple, Optional 
 from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import LocalEntryNotFoundError
 from segment_anything1.build_sam import sam_model_registry
 from segment_anything1.predictor import SamPredictor
+from segment_anything1.utils.transforms import ResizeLongestSide
 from segment_anything1.config import SAM1_MODELS, SAM_NAMES_MODELS
 from segment_anything2.config import SAM2_MODELS
 from segment_anything2.sam2_image_predictor import SAM2ImagePredictor
 from groundingdino.util import box_ops
-from groundingdino.util.inference import predict, load_model
+from groundingdino.util.inference import predict, predict_batch, load_model
 from torchvision.ops import box_convert
 from groundingdino.util.box_ops import box_cxcywh_to_xyxy
 from DataSets.getdata import thermal_feet_dataset, ToBoolTensor, PermuteTensor
 from torchvision.transforms import transforms
 import torch.nn as nn
+
+_CUDA_OK = torch.cuda.is_available()
+
 class GSamnet(nn.Module):
-    def __init__(self,dino_args =None,sam_args= None):
+    _dino_paths_cache: ClassVar[dict] = {}
+
+    def __init__(self,dino_args =None,sam_args= None,weights_path: Optional[str] = None):
         super(GSamnet, self).__init__()
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self._device = "cuda" if _CUDA_OK else "cpu"
         self.dino_args = dino_args
         self.sam_args = sam_args
+        self.weights_path = weights_path if weights_path is not None else os.path.join(torch.hub.get_dir(), "checkpoints")
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
+        self._scale_cache = {}
+        self._embed_cache_size = 8
+        self._copy_stream = None
 
         self.transform_mask = transforms.Compose([
             ToBoolTensor(),
@@ -35,6 +52,13 @@ class GSamnet(nn.Module):
             PermuteTensor((1,2,0)) #(WxHxC)
         ])
 
+    @property
+    def device(self) -> str:
+        """
+            The device the models run on.
+        """
+        return self._device
+
     def dummy_input(self):
         try:
             image,_,_ = thermal_feet_dataset.load_instance(root_name_img=os.path.join(os.path.dirname(__file__),"dummy_input","t0.jpg"),
@@ -60,18 +84,37 @@ class GSamnet(nn.Module):
         text_threshold = self.dino_args.get("text_threshold",0.30)
         box_process_threshold = self.dino_args.get("box_process_threshold",0.10)
         postproccesingv2 = self.dino_args.get("postprocessing",True)
+        dino_batch_size = self.dino_args.get("batch_size",8)
 
         area_threshold = self.sam_args.get("area_threshold",700)
+        image_arrays = [convert_image_to_numpy(img) for img in image]
+
+        # Run the pipeline once per distinct image and fan the results back out at the end
+        seen = {}
+        unique_indices = []
+        inverse = []
+        for idx, image_array in enumerate(image_arrays):
+            key = image_digest(image_array)
+            if key not in seen:
+                seen[key] = len(unique_indices)
+                unique_indices.append(idx)
+            inverse.append(seen[key])
+        image = [image[idx] for idx in unique_indices]
+        image_arrays = [image_arrays[idx] for idx in unique_indices]
+        image_digests = list(seen)
+
         boxes, logits, phrases, shape = self.predict_dino_batch(model=self.dino_args["model"],
                                                         images=image,
                                                         text_prompt=text_prompt,
                                                         box_threshold=box_threshold,
                                                         text_threshold=text_threshold,
                                                         box_process_threshold=box_process_threshold,
-                                                        postproccesingv2=postproccesingv2)
+                                                        postproccesingv2=postproccesingv2,
+                                                        batch_size=dino_batch_size,
+                                                        _image_arrays=image_arrays)
         H,W = shape
         if self.sam_args["points"]:
-            boxes_p = [box_cxcywh_to_xyxy(box) * torch.tensor([W,H,W,H]) for box in boxes]
+            boxes_p = [box_cxcywh_to_xyxy(box).mul_(self.__box_scale(W,H,box.device,box.dtype)) for box in boxes]
             result = [box_xyxy_to_point(box) for box in boxes_p]
             points_coords,points_labels = zip(*result)
         else:
@@ -84,22 +127,36 @@ class GSamnet(nn.Module):
                                     area_thresh=area_threshold,
                                     boxes=boxes,
                                     points_coords=points_coords,
-                                    points_labels=points_labels)
+                                    points_labels=points_labels,
+                                    _image_arrays=image_arrays,
+                                    _image_digests=image_digests)
                                     
             
         elif self.sam_args["model"].name == "SAM2":
-            boxes = [box_convert(box * torch.Tensor([W, H, W, H]), in_fmt="cxcywh", out_fmt="xyxy") for box in boxes]
+            boxes = [box_convert(box * self.__box_scale(W,H,box.device,box.dtype), in_fmt="cxcywh", out_fmt="xyxy") for box in boxes]
 
             mask = self.predict_SAM2_batch(model=self.sam_args["model"],
                                     images=image,
                                     area_thresh=area_threshold,
                                     boxes=boxes,
                                     points_coords=points_coords,
-                                    points_labels=points_labels)
+                                    points_labels=points_labels,
+                                    _image_arrays=image_arrays)
         
         
         if self.sam_args["torch"]:
             mask = [torch.Tensor(maski) for maski in mask]
+        # Repeated images get their own copies, so modifying one result never changes another
+        fanned = [], [], [], []
+        returned = set()
+        for idx in inverse:
+            result = (boxes[idx], logits[idx], phrases[idx], mask[idx])
+            if idx in returned:
+                result = copy.deepcopy(result)
+            returned.add(idx)
+            for out, value in zip(fanned, result):
+                out.append(value)
+        boxes, logits, phrases, mask = fanned
         if return_all:
             if unbatch:
                 return boxes[0],logits[0],phrases[0],mask[0]
@@ -139,15 +196,17 @@ class GSamnet(nn.Module):
         postproccesingv2 = args.get("postproccesingv2",False)
 
         image_trans = load_image(image)
-        image_array = convert_image_to_numpy(image)
-        shape =  image_array.shape[:2]
-        boxes, logits, phrases = predict(model=model,
-                                         image=image_trans,
-                                         caption=text_prompt,
-                                         box_threshold=box_threshold,
-                                         text_threshold=text_threshold,
-                                         device=self.device)
-        
+        shape = get_image_shape(image)
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16, enabled=self._device == "cuda"):
+            boxes, logits, phrases = predict(model=model,
+                                             image=image_trans,
+                                             caption=text_prompt,
+                                             box_threshold=box_threshold,
+                                             text_threshold=text_threshold,
+                                             device=self._device)
+        boxes = boxes.float()
+        logits = logits.float()
+
         if postproccesingv1:
             boxes,logits,phrases = PostProcessor().postprocess_box(image_shape=shape,
                                                             threshold=box_process_threshold,
@@ -176,23 +235,32 @@ class GSamnet(nn.Module):
                 box_threshold: The threshold for bounding box prediction.
                 text_threshold: The threshold for text prediction.
                 Normalize (optional): Whether to normalize the image. Defaults to False
+                batch_size (optional): Maximum number of images per GroundingDINO forward. Defaults to 8.
 
             Returns:
                 The predicted bounding boxes with (B,4) shape with logits and phrases.
         """
         postproccesingv1 = args.get("postproccesingv1",False)
         postproccesingv2 = args.get("postproccesingv2",True)
-        results = list(map(lambda image: self.predict_dino(model=model,
-                                                           image=image,
-                                                           text_prompt=text_prompt,
-                                                           box_threshold=box_threshold,
-                                                           text_threshold=text_threshold,
-                                                           box_process_threshold=box_process_threshold), images))
-        boxes, logits, phrases,_ = zip(*results)
-        boxes = list(boxes)
-        logits = list(logits)
-        phrases = list(phrases)
-        shape =  images[0].shape[:2]
+        batch_size = args.get("batch_size",8)
+        images_trans = [load_image(image) for image in images]
+        boxes, logits, phrases = [], [], []
+        # Bound the padded batch so large DataLoader batches do not run out of GPU memory
+        for start in range(0, len(images_trans), batch_size):
+            with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16, enabled=self._device == "cuda"):
+                chunk_boxes, chunk_logits, chunk_phrases = predict_batch(model=model,
+                                                                         images=images_trans[start:start + batch_size],
+                                                                         caption=text_prompt,
+                                                                         box_threshold=box_threshold,
+                                                                         text_threshold=text_threshold,
+                                                                         device=self._device)
+            boxes.extend(chunk_boxes)
+            logits.extend(chunk_logits)
+            phrases.extend(chunk_phrases)
+        boxes = [box.float() for box in boxes]
+        logits = [logit.float() for logit in logits]
+        image_arrays = args.get("_image_arrays",None)
+        shape = image_arrays[0].shape[:2] if image_arrays is not None else get_image_shape(images[0])
         if postproccesingv1:
             boxes,logits,phrases = PostProcessor().postprocess_box(image_shape=shape,
                                                                    threshold=box_process_threshold,
@@ -212,7 +280,8 @@ class GSamnet(nn.Module):
                      area_thresh: float,
                      boxes: Optional[torch.Tensor] = None,
                      points_coords: Optional[torch.Tensor] = None,
-                     points_labels: Optional[torch.Tensor] = None) -> torch.Tensor:
+                     points_labels: Optional[torch.Tensor] = None,
+                     _image_array: Optional[np.ndarray] = None) -> torch.Tensor:
         """
             Run the SAM1 model for image segmentation.
 
@@ -226,21 +295,141 @@ class GSamnet(nn.Module):
             Returns
                 The predicted segmentation mask with (WxHx1) shape.
     """
-        image_array = convert_image_to_numpy(image)
+        masks, copied = self.__infer_SAM1(model=model,
+                                          image=image,
+                                          boxes=boxes,
+                                          points_coords=points_coords,
+                                          points_labels=points_labels,
+                                          _image_array=_image_array)
+        return self.__finalize_SAM1(masks=masks, area_thresh=area_thresh, copied=copied)
+
+    def __infer_SAM1(self,
+                     model,
+                     image: Union[Image.Image,
+                                  torch.Tensor,
+                                  np.ndarray],
+                     boxes: Optional[torch.Tensor] = None,
+                     points_coords: Optional[torch.Tensor] = None,
+                     points_labels: Optional[torch.Tensor] = None,
+                     _image_array: Optional[np.ndarray] = None,
+                     _image_digest: Optional[bytes] = None) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        """
+            Run the SAM1 encoder and decoder for a single image and start copying the masks to host.
+
+            Returns
+                The raw predicted masks with (Bx1xHxW) shape and the event marking the end of their copy.
+        """
+        image_array = _image_array if _image_array is not None else convert_image_to_numpy(image)
         transformed_boxes,transformed_points,points_labels = self.__prep_prompts_SAM1(boxes,
                                                                                  points_coords,
                                                                                  points_labels,
-                                                                                 image_array.shape[:2])
-
-        model.set_image(image_array)
-        masks, _, _ = model.predict_torch(point_coords=transformed_points.to(self.device) if transformed_points is not None else None,
-                                          point_labels=points_labels.to(self.device) if points_labels is not None else None,
-                                          boxes=transformed_boxes.to(self.device) if transformed_boxes is not None else None,
-                                          multimask_output=False,)
-        model.reset_image()
+                                                                                 image_array.shape[:2],
+                                                                                 model.transform)
+
+        key = _image_digest if _image_digest is not None else image_digest(image_array)
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16, enabled=self._device == "cuda"):
+            if not self.__restore_SAM1_embedding(model=model, key=key):
+                model.set_image(image_array)
+                self.__store_SAM1_embedding(model=model, key=key)
+            masks, _, _ = model.predict_torch(point_coords=transformed_points.to(self._device) if transformed_points is not None else None,
+                                              point_labels=points_labels.to(self._device) if points_labels is not None else None,
+                                              boxes=transformed_boxes.to(self._device) if transformed_boxes is not None else None,
+                                              multimask_output=False,)
+            model.reset_image()
+            masks, copied = self.__masks_to_host(masks)
+        return masks, copied
+
+    def __masks_to_host(self, masks: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        """
+            Copy the masks to pinned host memory on a dedicated stream, so the copy overlaps with the next image.
+            Pinned blocks are recycled by the torch caching host allocator once the copy has finished.
+            The copy stream is created on first use.
+
+            Args:
+                masks: The masks on device.
+
+            Returns
+                The host masks and the event to wait on before reading them. Without CUDA the masks are returned as is.
+        """
+        if self._device != "cuda":
+            return masks, None
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream()
+        host_masks = torch.empty(masks.shape, dtype=masks.dtype, pin_memory=True)
+        self._copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._copy_stream):
+            host_masks.copy_(masks, non_blocking=True)
+            masks.record_stream(self._copy_stream)
+            copied = torch.cuda.Event()
+            copied.record()
+        return host_masks, copied
+
+    def __SAM1_embedding_cache(self, model) -> OrderedDict:
+        """
+            Return the image embedding cache of a SAM1 predictor. It lives on the predictor so entries never outlive the model.
+
+            Args:
+                model: The SAM1 predictor.
+
+            Returns
+                The LRU cache mapping image digests to (features, original_size, input_size).
+        """
+        cache = getattr(model, "_embed_cache", None)
+        if cache is None:
+            cache = OrderedDict()
+            model._embed_cache = cache
+        return cache
+
+    def __restore_SAM1_embedding(self, model, key: bytes) -> bool:
+        """
+            Restore a cached image embedding into the SAM1 predictor, skipping the image encoder.
+
+            Args:
+                model: The SAM1 predictor.
+                key: The digest of the image.
+
+            Returns
+                Whether the embedding was found in the cache.
+        """
+        embed_cache = self.__SAM1_embedding_cache(model)
+        cached = embed_cache.get(key)
+        if cached is None:
+            return False
+        embed_cache.move_to_end(key)
+        model.features, model.original_size, model.input_size = cached
+        model.is_image_set = True
+        return True
+
+    def __store_SAM1_embedding(self, model, key: bytes) -> None:
+        """
+            Store the image embedding of the SAM1 predictor, evicting the least recently used entry when full.
+
+            Args:
+                model: The SAM1 predictor with an image already set.
+                key: The digest of the image.
+        """
+        embed_cache = self.__SAM1_embedding_cache(model)
+        # Only a compiled encoder hands out buffers it reuses on the next call; eager, graph and TRT outputs are fresh
+        features = model.features.clone() if getattr(model, "_clone_features", False) else model.features
+        embed_cache[key] = (features, model.original_size, model.input_size)
+        if len(embed_cache) > self._embed_cache_size:
+            embed_cache.popitem(last=False)
+
+    def __finalize_SAM1(self,
+                        masks: torch.Tensor,
+                        area_thresh: float,
+                        copied: Optional[torch.cuda.Event] = None) -> np.ndarray:
+        """
+            Remove small regions from the SAM1 masks and merge them into a single mask.
+
+            Returns
+                The merged segmentation mask with (WxHx1) shape.
+        """
+        if copied is not None:
+            copied.synchronize()
+        # postprocess_masks already returns the masks on host
         masks = PostProcessor().postprocess_masks(masks=masks,
                                                 area_thresh=area_thresh)
-        masks = masks.cpu()
         mask = torch.any(masks,dim=0).permute(1,2,0).numpy()
         return mask
     
@@ -253,15 +442,21 @@ class GSamnet(nn.Module):
                            area_thresh: float,
                            boxes:Optional[List[torch.Tensor]] = None,
                            points_coords:Optional[List[torch.Tensor]] = None,
-                           points_labels:Optional[List[torch.Tensor]] = None) -> List[torch.Tensor]:
+                           points_labels:Optional[List[torch.Tensor]] = None,
+                           num_workers: int = 4,
+                           _image_arrays: Optional[List[np.ndarray]] = None,
+                           _image_digests: Optional[List[bytes]] = None) -> List[torch.Tensor]:
         """
             Run the SAM1 model for batch prediction.
+            The predictor is stateful, so images go through the GPU one at a time while a thread pool
+            post-processes the masks of previous images on CPU.
 
             Args:
                 images: The input images with (WxHxC) shape.
                 boxes: List of bounding boxes for each image. Can be None.
                 points_coords: List of point coordinates for each image. Can be None.
                 points_labels: List of point labels for each image. Can be None.
+                num_workers (optional): Number of threads used for mask post-processing. Defaults to 4.
 
             Returns:
                 The predicted masks for each image.
@@ -276,6 +471,10 @@ class GSamnet(nn.Module):
         if points_coords is None:
             points_coords = [None] * len(images)
             points_labels = [None] * len(images)
+        if _image_arrays is None:
+            _image_arrays = [None] * len(images)
+        if _image_digests is None:
+            _image_digests = [None] * len(images)
 
         if not (len(images) == len(boxes) == len(points_coords) == len(points_labels)):
             raise ValueError("The lengths of 'images', 'boxes', 'points_coords', and 'points_labels' must match.")
@@ -283,7 +482,9 @@ class GSamnet(nn.Module):
         def process_image(image: Union[Image.Image,torch.Tensor,np.ndarray],
                           box: Optional[torch.Tensor],
                           point_coord: Optional[torch.Tensor],
-                          point_label: Optional[torch.Tensor]) -> torch.Tensor:
+                          point_label: Optional[torch.Tensor],
+                          image_array: Optional[np.ndarray],
+                          digest: Optional[bytes]) -> Future:
             """
                 Process a single image with its corresponding boxes and points.
 
@@ -292,19 +493,24 @@ class GSamnet(nn.Module):
                     box: The bounding boxes for the image.
                     point_coords: The point coordinates for the image.
                     point_labels: The point labels for the image.
+                    image_array: The image already converted to numpy. Can be None.
+                    digest: The digest of the image. Can be None.
 
                 Returns:
-                    np.ndarray: The predicted mask for the image.
+                    Future: The pending post-processing of the predicted mask for the image.
             """
             nonlocal model
-            mask = self.predict_SAM1(model=model,
-                                     image=image,
-                                     area_thresh=area_thresh,
-                                     boxes=box,
-                                     points_coords=point_coord,
-                                     points_labels=point_label)
-            return mask
-        results = [process_image(image, box, point_coords, point_labels) for image, box, point_coords, point_labels in zip(images, boxes, points_coords, points_labels)]
+            masks, copied = self.__infer_SAM1(model=model,
+                                              image=image,
+                                              boxes=box,
+                                              points_coords=point_coord,
+                                              points_labels=point_label,
+                                              _image_array=image_array,
+                                              _image_digest=digest)
+            return executor.submit(self.__finalize_SAM1, masks, area_thresh, copied)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [process_image(image, box, point_coords, point_labels, image_array, digest) for image, box, point_coords, point_labels, image_array, digest in zip(images, boxes, points_coords, points_labels, _image_arrays, _image_digests)]
+            results = [future.result() for future in futures]
         return results
     
     def predict_SAM2(self,
@@ -315,7 +521,8 @@ class GSamnet(nn.Module):
                      area_thresh: float,
                      boxes: np.ndarray, 
                      point_coords: np.ndarray,
-                     point_labels: np.ndarray) -> torch.Tensor:
+                     point_labels: np.ndarray,
+                     _image_array: Optional[np.ndarray] = None) -> torch.Tensor:
         
         """
             Run the SAM2 model for image segmentation.
@@ -331,7 +538,7 @@ class GSamnet(nn.Module):
                 The predicted segmentation mask with (WxHx1) shape.
             
         """
-        image_array = convert_image_to_numpy(image)
+        image_array = _image_array if _image_array is not None else convert_image_to_numpy(image)
         box,point_coords,point_labels = self.__prep_prompts_SAM2(boxes=boxes,points_coords=point_coords,points_labels=point_labels)
         with torch.inference_mode(),  torch.autocast("cuda", dtype=torch.bfloat16):
             model.set_image(image_array)
@@ -344,7 +551,6 @@ class GSamnet(nn.Module):
             masks = torch.Tensor(masks).to(torch.bool)
             masks = PostProcessor().postprocess_masks(masks=masks,
                                                 area_thresh=area_thresh)
-            masks = masks.cpu()
             mask = torch.any(masks,dim=0).permute(1,2,0).numpy()
         return mask
     
@@ -355,7 +561,8 @@ class GSamnet(nn.Module):
                            points_labels: List[Union[np.ndarray]],
                            boxes: List[Union[np.ndarray]],
                            area_thresh: float,
-                           multimask_output: bool = False) -> List[torch.Tensor]:
+                           multimask_output: bool = False,
+                           _image_arrays: Optional[List[np.ndarray]] = None) -> List[torch.Tensor]:
         """
             Run the SAM2 model for batch prediction.
 
@@ -368,15 +575,18 @@ class GSamnet(nn.Module):
             Returns:
                 The predicted masks for each image.
         """
+        if _image_arrays is None:
+            _image_arrays = [None] * len(images)
         masks = []
-        for image,box,point,label in zip(images,boxes,points_coords,points_labels):
+        for image,box,point,label,image_array in zip(images,boxes,points_coords,points_labels,_image_arrays):
             
             mask = self.predict_SAM2(model=model,
                                         image=image,
                                         area_thresh=area_thresh,
                                         boxes=box,
                                         point_coords=point,
-                                        point_labels=label)
+                                        point_labels=label,
+                                        _image_array=image_array)
             masks.append(mask)
         return masks
 
@@ -384,7 +594,8 @@ class GSamnet(nn.Module):
                        boxes: Optional[torch.Tensor],
                        points_coords: Optional[torch.Tensor],
                        points_labels: Optional[torch.tensor],
-                       dims: tuple) -> Tuple[Optional[torch.Tensor],Optional[torch.Tensor],Optional[torch.Tensor]]:
+                       dims: tuple,
+                       transform: ResizeLongestSide) -> Tuple[Optional[torch.Tensor],Optional[torch.Tensor],Optional[torch.Tensor]]:
         """
             Prepare the prompts to be used by SAM1.
 
@@ -392,7 +603,8 @@ class GSamnet(nn.Module):
                 boxes: Tensor of box coordinates
                 points_coords: Tensor of point coordinates
                 points_labels: Tensor of point labels
-                dims: Image dimensions
+                dims: Image dimensions (H,W)
+                transform: The resize transform of the SAM1 predictor
 
             Return:
                 The processed prompts
@@ -401,10 +613,9 @@ class GSamnet(nn.Module):
         H,W = dims 
 
         if boxes is not None:
-            clip_valor = np.clip(boxes[0][0], 0, 1)
-            if clip_valor == boxes[0][0]:
-                boxes = box_ops.box_cxcywh_to_xyxy(boxes) * torch.Tensor([W,H,W,H])
-                transformed_boxes = self.SAM1.transform.apply_boxes_torch(boxes, (W,H))
+            if bool((boxes[0, 0] >= 0) & (boxes[0, 0] <= 1)):
+                boxes = box_ops.box_cxcywh_to_xyxy(boxes).mul_(self.__box_scale(W,H,boxes.device,boxes.dtype))
+                transformed_boxes = transform.apply_boxes_torch(boxes, dims)
             else:
                 transformed_boxes = boxes #Agregado 
         else:
@@ -415,7 +626,7 @@ class GSamnet(nn.Module):
         elif points_labels is not None and points_coords is None:
             raise ValueError("If 'points_labels' is provided, 'points_coords' must also be provided, and vice versa.")
         elif points_coords is not None and points_labels is not None:
-            transformed_points = self.SAM1.transform.apply_coords_torch(points_coords, dims)
+            transformed_points = transform.apply_coords_torch(points_coords, dims)
         else:
              transformed_points = None
              points_labels = None
@@ -423,6 +634,30 @@ class GSamnet(nn.Module):
         return transformed_boxes,transformed_points,points_labels
     
         
+    def __box_scale(self,
+                    W: int,
+                    H: int,
+                    device: torch.device,
+                    dtype: torch.dtype) -> torch.Tensor:
+        """
+            Return the cached [W,H,W,H] tensor used to scale normalized boxes to pixels.
+
+            Args:
+                W: Image width
+                H: Image height
+                device: Device of the boxes to scale
+                dtype: Dtype of the boxes to scale
+
+            Return:
+                The scale tensor with (4,) shape
+        """
+        key = (W, H, device, dtype)
+        scale = self._scale_cache.get(key)
+        if scale is None:
+            scale = torch.tensor([W, H, W, H], device=device, dtype=dtype)
+            self._scale_cache[key] = scale
+        return scale
+
     def __prep_prompts_SAM2(self,
                        boxes: Optional[torch.Tensor],
                        points_coords: Optional[torch.Tensor],
@@ -440,21 +675,51 @@ class GSamnet(nn.Module):
 
         return transformed_boxes,transformed_points,transformed_labels
     
-    def __Build_GroundingDINO(self,return_model:Optional[bool] =  None):
+    def __hf_download(self, repo_id: str, filename: str) -> str:
+        """
+            Resolve a file from huggingface_hub, preferring the local cache and remembering the path for later instances.
+
+            Args:
+                repo_id: The huggingface_hub repository.
+                filename: The file inside the repository.
+
+            Returns:
+                The local path of the file.
+        """
+        key = (repo_id, filename)
+        if key not in GSamnet._dino_paths_cache:
+            try:
+                path = hf_hub_download(repo_id=repo_id, filename=filename, local_files_only=True)
+            except LocalEntryNotFoundError:
+                path = hf_hub_download(repo_id=repo_id, filename=filename)
+            GSamnet._dino_paths_cache[key] = path
+        return GSamnet._dino_paths_cache[key]
+
+    def __Build_GroundingDINO(self,
+                              return_model:Optional[bool] =  None,
+                              use_compile: bool = False):
         """
             Build the Grounding DINO model.
+
+            Args:
+                use_compile (optional): Whether to compile the model with torch.compile. Defaults to False.
+                    The model is compiled with static shapes and no warm-up, so the first call for each batch size
+                    and resized image shape pays the compile time.
         """
         repo_id = "ShilongLiu/GroundingDINO"
         filename = "groundingdino_swint_ogc.pth"
         cache_config = "GroundingDINO_SwinT_OGC.cfg.py"
         try:
-            cache_config_file = hf_hub_download(repo_id=repo_id, filename=cache_config)
-            pth_file = hf_hub_download(repo_id=repo_id, filename=filename)
+            cache_config_file = self.__hf_download(repo_id=repo_id, filename=cache_config)
+            pth_file = self.__hf_download(repo_id=repo_id, filename=filename)
         except:
             raise RuntimeError(f"Error downloading GroundingDINO model. Please ensure that the {repo_id}/{cache_config} file exists in huggingface_hub and the {filename} checkpoint is functional.")
         
         try:
-            groundingdino = load_model(cache_config_file,pth_file, device=self.device)
+            groundingdino = load_model(cache_config_file,pth_file, device=self._device)
+            if use_compile:
+                torch._dynamo.config.suppress_errors = True
+                groundingdino = torch.compile(groundingdino, mode="reduce-overhead", fullgraph=False, dynamic=False)
             if return_model is not None:
                 if return_model:
                     return groundingdino
@@ -466,29 +731,137 @@ class GSamnet(nn.Module):
     
     def __Build_SAM1(self,
                      SAM:str,
-                     return_model:Optional[bool] = None) -> None:
+                     return_model:Optional[bool] = None,
+                     use_trt: bool = False,
+                     use_compile: bool = False,
+                     disable_encoder_cudagraph: bool = False) -> None:
         """
             Build the SAM1 model.
 
             Args:
                 SAM: The name of the SAM model to build.
+                use_trt (optional): Whether to run the image encoder with a TensorRT engine. Defaults to False.
+                use_compile (optional): Whether to compile the image encoder with torch.compile. Ignored when use_trt is set. Defaults to False.
+                disable_encoder_cudagraph (optional): Whether to skip capturing the image encoder in a CUDA Graph. Defaults to False.
         """
+        if SAM not in SAM1_MODELS or SAM not in sam_model_registry:
+            raise ValueError(f"{SAM} is not a SAM1 model available, try {list(SAM1_MODELS)}")
+        checkpoint_url = SAM1_MODELS[SAM]
         try:
-            checkpoint_url = SAM1_MODELS[SAM]
-            sam = sam_model_registry[SAM]()
-            state_dict = torch.hub.load_state_dict_from_url(checkpoint_url)
+            # Build on meta so no weights are initialized; the checkpoint tensors are assigned straight from the target device
+            with torch.device("meta"):
+                sam = sam_model_registry[SAM]()
+            state_dict = torch.hub.load_state_dict_from_url(checkpoint_url, model_dir=self.weights_path, map_location=self._device)
         except Exception as e:
-            raise RuntimeError(f"Error downloading SAM1. Please ensure the model is correct: {SAM} and that the checkpoint is functional: {checkpoint_url}.")
+            raise RuntimeError(f"Error downloading SAM1. Please ensure that the checkpoint is functional: {checkpoint_url}. {e}")
         try:
-            sam.load_state_dict(state_dict, strict=True)
-            sam.to(device=self.device)
+            sam.load_state_dict(state_dict, strict=True, assign=True)
+            # pixel_mean/pixel_std are not in the checkpoint; the legacy torch.Tensor constructor left them on host
+            sam.to(device=self._device)
+            if self._device == "cuda" and not use_trt:
+                sam.image_encoder.to(memory_format=torch.channels_last)
+            if use_trt:
+                self.__Build_SAM1_TRT(sam=sam, SAM=SAM)
+            elif use_compile:
+                self.__Compile_SAM1(sam=sam)
+            elif not disable_encoder_cudagraph and self._device == "cuda":
+                self.__Capture_SAM1_Graph(sam=sam)
             SAM1 = SamPredictor(sam)
+            SAM1._clone_features = use_compile and not use_trt
             if return_model is not None:
                 if return_model:
                     return SAM1
         except Exception as e:
             raise RuntimeError(f"SAM1 model can't be compile: {str(e)}")
 
+    def __Build_SAM1_TRT(self,
+                         sam,
+                         SAM: str) -> None:
+        """
+            Replace the SAM1 image encoder with a TensorRT FP16 engine, exporting and caching it on first use.
+            The cached engine is named after the TensorRT version and GPU, and rebuilt if it cannot be deserialized.
+            Once the engine is loaded the PyTorch encoder is dropped, releasing its weights.
+
+            Args:
+                sam: The SAM1 model already placed on device.
+                SAM: The name of the SAM model, used to name the cached engine.
+        """
+        if self._device != "cuda":
+            raise RuntimeError("TensorRT engines for SAM1 require a CUDA device.")
+        img_size = sam.image_encoder.img_size
+        engine_path = os.path.join(self.weights_path, f"sam1_{SAM}_image_encoder_fp16_{trt_engine_tag()}.plan")
+        if os.path.exists(engine_path):
+            try:
+                sam.image_encoder = TRTImageEncoder(TRTRunner(engine_path), img_size)
+                return
+            except RuntimeError as e:
+                print(f"Warning: Rebuilding the TensorRT engine {engine_path}: {e}")
+        os.makedirs(self.weights_path, exist_ok=True)
+        onnx_path = os.path.splitext(engine_path)[0] + ".onnx"
+        dummy = torch.zeros(1, 3, img_size, img_size, device=self._device)
+        with torch.no_grad():
+            torch.onnx.export(sam.image_encoder,
+                              dummy,
+                              onnx_path,
+                              input_names=["image"],
+                              output_names=["image_embeddings"],
+                              opset_version=17)
+        build_trt_engine(onnx_path=onnx_path, engine_path=engine_path, fp16=True)
+        sam.image_encoder = TRTImageEncoder(TRTRunner(engine_path), img_size)
+
+    def __Compile_SAM1(self, sam) -> None:
+        """
+            Compile the SAM1 image encoder in place and run one warm-up forward to amortize the compile time.
+
+            Args:
+                sam: The SAM1 model already placed on device.
+        """
+        torch._dynamo.config.suppress_errors = True
+        sam.image_encoder.compile(mode="reduce-overhead", fullgraph=False, dynamic=False)
+        img_size = sam.image_encoder.img_size
+        # Same grad and autocast state as __infer_SAM1, so the first real call does not recompile
+        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16, enabled=self._device == "cuda"):
+            sam.image_encoder(torch.zeros(1, 3, img_size, img_size, device=self._device))
+
+    def __Capture_SAM1_Graph(self, sam) -> None:
+        """
+            Capture the SAM1 image encoder in a CUDA Graph and replay it for inputs with the captured shape.
+            The encoder input is always padded to a fixed size, so a single graph serves every image.
+            The graph is recorded under BF16 autocast and only replayed for calls under autocast with grad disabled
+            (as __infer_SAM1 is); other calls run the eager encoder. The encoder parameters are frozen
+            (requires_grad=False) so the graph can record the weight casts; the rest of SAM is left untouched.
+
+            Args:
+                sam: The SAM1 model already placed on device.
+        """
+        encoder = sam.image_encoder
+        eager_forward = encoder.forward
+        img_size = encoder.img_size
+        static_input = torch.zeros(1, 3, img_size, img_size, device=self._device)
+        # The graph must record the weight casts itself: cached autocast copies are freed when the block exits
+        encoder.requires_grad_(False)
+
+        with torch.no_grad(), torch.autocast("cuda", dtype=torch.bfloat16, cache_enabled=False):
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                for _ in range(3):
+                    eager_forward(static_input)
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = eager_forward(static_input)
+
+        def forward(x: torch.Tensor) -> torch.Tensor:
+            if x.shape != static_input.shape or not torch.is_autocast_enabled() or torch.is_grad_enabled():
+                return eager_forward(x)
+            static_input.copy_(x)
+            graph.replay()
+            return static_output.clone()
+
+        encoder.forward = forward
+
     def __Build_SAM2(self,
                      SAM:str,
                      return_model: Optional[bool] = None) -> None:
@@ -499,28 +872,31 @@ class GSamnet(nn.Module):
                 SAM: The name of the SAM model to build.
         """
         try:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
             checkpoint_url = SAM2_MODELS[SAM]
-            SAM2 = SAM2ImagePredictor.from_pretrained(checkpoint_url,device=device)
+            SAM2 = SAM2ImagePredictor.from_pretrained(checkpoint_url,device=self._device)
             if return_model is not None:
                 if return_model:
                     return SAM2
         except Exception as e:
             raise RuntimeError(f"Error downloading or Compile {SAM} model. Please ensure that {SAM2_MODELS[SAM]} is functional: {e}")
 
-def load_models(model):
+def load_models(model,**args):
+    weights_path = args.get("weights_path",None)
+    use_trt = args.get("use_trt",False)
+    use_compile = args.get("use_compile",False)
+    disable_encoder_cudagraph = args.get("disable_encoder_cudagraph",False)
 
     if model == "dino":
-        modelo = GSamnet()._GSamnet__Build_GroundingDINO(return_model=True)
+        modelo = GSamnet(weights_path=weights_path)._GSamnet__Build_GroundingDINO(return_model=True,use_compile=use_compile)
         modelo.name = "dino"
         return modelo
     else:
         if model in SAM1_MODELS:
-            modelo = GSamnet()._GSamnet__Build_SAM1(model,return_model=True)
+            modelo = GSamnet(weights_path=weights_path)._GSamnet__Build_SAM1(model,return_model=True,use_trt=use_trt,use_compile=use_compile,disable_encoder_cudagraph=disable_encoder_cudagraph)
             modelo.name = "SAM1"
             return modelo
         elif model in SAM2_MODELS:
-            modelo = GSamnet()._GSamnet__Build_SAM2(model, return_model=True)
+            modelo = GSamnet(weights_path=weights_path)._GSamnet__Build_SAM2(model, return_model=True)
             modelo.name = "SAM2"
             return modelo
         else:
@@ -528,7 +904,7 @@ def load_models(model):
         
 
 if __name__ == "__main__":
-    from groundino_samnet.utils import PostProcessor, PostProcessor2, load_image, convert_image_to_numpy, box_xyxy_to_point
+    from groundino_samnet.utils import PostProcessor, PostProcessor2, load_image, convert_image_to_numpy, get_image_shape, box_xyxy_to_point, build_trt_engine, trt_engine_tag, TRTRunner, TRTImageEncoder, image_digest
     sam = load_models("sam2_t")
     dino = load_models("dino")
 
@@ -551,4 +927,4 @@ if __name__ == "__main__":
     model = GSamnet(dino_args=dino_args,sam_args=sam_args)
 
 else:
-    from .utils import PostProcessor, PostProcessor2, load_image, convert_image_to_numpy, box_xyxy_to_point
\ No newline at end of file
+    from .utils import PostProcessor, PostProcessor2, load_image, convert_image_to_numpy, get_image_shape, box_xyxy_to_point, build_trt_engine, trt_engine_tag, TRTRunner, TRTImageEncoder, image_digest
\ No newline at end of file
@@ -1,11 +1,11 @@
+import hashlib
+import re
 import numpy as np
 import torch
 from PIL import Image
 from typing import Union, Tuple, List
-from torchvision.transforms import transforms
 from groundingdino.datasets import transforms as T
 from groundingdino.util.box_ops import box_cxcywh_to_xyxy, box_xyxy_to_cxcywh, box_iou
-from DataSets.getdata import PermuteTensor
 from segment_anything1.utils.amg import remove_small_regions
 import cv2
 
@@ -28,6 +28,54 @@ def load_image_from_PIL(img:Image.Image) -> torch.Tensor:
     image, _ = transform(img,None)
     return image
 
+def get_resize_shape(height: int, width: int, size: int = 800, max_size: int = 1333) -> Tuple[int, int]:
+    """
+        Compute the output shape of the GroundingDINO resize: shorter side to size, longer side capped at max_size.
+
+        Args:
+            height: The image height
+            width: The image width
+            size (optional): Target size of the shorter side. Defaults to 800.
+            max_size (optional): Maximum size of the longer side. Defaults to 1333.
+
+        Returns:
+            The resized (H,W) shape
+    """
+    min_original_size = float(min((width, height)))
+    max_original_size = float(max((width, height)))
+    if max_original_size / min_original_size * size > max_size:
+        size = int(round(max_size * min_original_size / max_original_size))
+
+    if (width <= height and width == size) or (height <= width and height == size):
+        return (height, width)
+
+    if width < height:
+        return (int(size * height / width), size)
+    return (size, int(size * width / height))
+
+_NORMALIZE_CACHE = {}
+
+def load_image_from_tensor(img: torch.Tensor) -> torch.Tensor:
+    """
+        Resize and normalize a (CxHxW) tensor image on its own device, as load_image_from_PIL does without the PIL round-trip.
+
+        Args:
+            img: A single image tensor, uint8 in [0,255] or float in [0,1]
+
+        Returns:
+            image: A single torch.Tensor for GroundingDINO
+    """
+    image = img.float() / 255 if img.dtype == torch.uint8 else img.float()
+    size = get_resize_shape(image.shape[-2], image.shape[-1])
+    image = torch.nn.functional.interpolate(image[None], size=size, mode="bilinear", align_corners=False, antialias=True)[0]
+    normalize = _NORMALIZE_CACHE.get(image.device)
+    if normalize is None:
+        normalize = (torch.tensor([0.485, 0.456, 0.406], device=image.device).view(3, 1, 1),
+                     torch.tensor([0.229, 0.224, 0.225], device=image.device).view(3, 1, 1))
+        _NORMALIZE_CACHE[image.device] = normalize
+    mean, std = normalize
+    return (image - mean) / std
+
 def build_model(args):
     # we use register to maintain models from catdet6 on.
     from groundingdino.models import MODULE_BUILD_FUNCS
@@ -55,33 +103,41 @@ def load_image(image: Union[Image.Image,
     elif isinstance(image, torch.Tensor):
         if image.shape[0] != 3:
             image = image.permute((2, 0, 1))
-        transformed_image = transforms.ToPILImage()(image)
-        transformed_image = load_image_from_PIL(transformed_image)
+        transformed_image = load_image_from_tensor(image)
 
     elif isinstance(image, np.ndarray):
-        if image.shape[0] == 3:        
-            transform = transforms.Compose([
-                transforms.ToTensor(),
-                transforms.ToPILImage(),
-            ])
-        else:
-            transform = transforms.Compose([
-                transforms.ToTensor(),
-                PermuteTensor((2, 0, 1)),
-                transforms.ToPILImage(),
-            ])  
-        transformed_image = transform(image)
-        transformed_image = load_image_from_PIL(transformed_image)
+        image = torch.from_numpy(np.ascontiguousarray(image))
+        if image.shape[0] != 3:
+            image = image.permute((2, 0, 1))
+        transformed_image = load_image_from_tensor(image)
     else:
         raise TypeError(f"Unsupported image type: {type(image)}. Please provide a PIL Image, torch.Tensor, or np.ndarray.")
 
     return transformed_image
 
+def get_image_shape(image: Union[Image.Image,
+                                  torch.Tensor,
+                                  np.ndarray]) -> Tuple[int, int]:
+    """
+        Read the (H,W) shape of an image without converting it, following the layout rules of convert_image_to_numpy.
+
+        Args:
+            image: The input image.
+
+        Returns:
+            The (H,W) shape of the image.
+    """
+    if isinstance(image, Image.Image):
+        return tuple(image.size[::-1])
+    elif isinstance(image,(torch.Tensor,np.ndarray)):
+        return tuple(image.shape[1:3]) if image.shape[0] == 3 else tuple(image.shape[:2])
+    raise TypeError(f"Unsupported image type: {type(image)}. Please provide a PIL Image, torch.Tensor, or np.ndarray.")
+
 def convert_image_to_numpy(image: Union[Image.Image,
                                         torch.Tensor,
                                         np.ndarray]) -> np.ndarray:
     """
-        Convert an image from various formats (PIL, Tensor) to a Numpy
+        Convert an image from various formats (PIL, Tensor) to a Numpy. Device tensors are copied to host.
         
         Args:
             image: The input image.
@@ -92,7 +148,7 @@ def convert_image_to_numpy(image: Union[Image.Image,
     if isinstance(image,torch.Tensor):
         if image.shape[0] == 3:
             image = image.permute((1,2,0))
-        image_array = image.numpy()
+        image_array = image.detach().cpu().numpy()
     elif isinstance(image, Image.Image):
         image_array = np.asarray(image)
     elif isinstance(image,np.ndarray):
@@ -103,6 +159,22 @@ def convert_image_to_numpy(image: Union[Image.Image,
         raise TypeError(f"Unsupported image type: {type(image)}. Please provide a PIL Image, torch.Tensor, or np.ndarray.")
     return image_array
 
+def image_digest(image_array: np.ndarray) -> bytes:
+    """
+        Hash the content of an image so identical images can be recognized regardless of the object holding them.
+
+        Args:
+            image_array: The image as a numpy array.
+
+        Returns:
+            A 16 bytes blake2b digest of the image shape, dtype and pixels.
+    """
+    image_array = np.ascontiguousarray(image_array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image_array.shape}{image_array.dtype}".encode())
+    digest.update(image_array)
+    return digest.digest()
+
 def box_xyxy_to_point(boxes,
                       neg_point:bool=False):
     """
@@ -129,6 +201,110 @@ def box_xyxy_to_point(boxes,
                 idx += 5
     return points_coords, points_labels
 
+def build_trt_engine(onnx_path: str,
+                     engine_path: str,
+                     fp16: bool = True,
+                     workspace: int = 1 << 32) -> None:
+    """
+        Build a serialized TensorRT engine from an ONNX file.
+
+        Args:
+            onnx_path: Path of the exported ONNX model.
+            engine_path: Path where the serialized engine (.plan) is written.
+            fp16 (optional): Whether to allow FP16 kernels. Defaults to True.
+            workspace (optional): Builder workspace size in bytes. Defaults to 4 GiB.
+    """
+    try:
+        import tensorrt as trt
+    except ImportError:
+        raise ImportError("TensorRT is required to build engines. Please install it with 'pip install tensorrt'.")
+
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse_from_file(onnx_path):
+        errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+        raise RuntimeError(f"Error parsing the ONNX model {onnx_path}: {errors}")
+
+    config = builder.create_builder_config()
+    config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, workspace)
+    if fp16:
+        config.set_flag(trt.BuilderFlag.FP16)
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError(f"TensorRT could not build an engine from {onnx_path}.")
+    with open(engine_path, "wb") as f:
+        f.write(serialized_engine)
+
+_TRT_TO_TORCH_DTYPES = {"FLOAT": torch.float32,
+                        "HALF": torch.float16,
+                        "BF16": torch.bfloat16,
+                        "INT8": torch.int8,
+                        "UINT8": torch.uint8,
+                        "INT32": torch.int32,
+                        "INT64": torch.int64,
+                        "BOOL": torch.bool}
+
+def trt_engine_tag() -> str:
+    """
+        Identify the TensorRT version and GPU a serialized engine is built for, since engines are not portable across either.
+
+        Returns:
+            A filename-safe tag such as 'trt10.0.1_NVIDIA_A100-SXM4-40GB'.
+    """
+    try:
+        import tensorrt as trt
+    except ImportError:
+        raise ImportError("TensorRT is required to build engines. Please install it with 'pip install tensorrt'.")
+    device_name = re.sub(r"[^A-Za-z0-9.-]+", "_", torch.cuda.get_device_name())
+    return f"trt{trt.__version__}_{device_name}"
+
+class TRTRunner:
+    """
+        Run a serialized TensorRT engine with a single input and a single output on torch CUDA tensors.
+        Device buffers are owned by torch so the engine shares the current CUDA stream and allocator.
+    """
+    def __init__(self, engine_path: str):
+        try:
+            import tensorrt as trt
+        except ImportError:
+            raise ImportError("TensorRT is required to run engines. Please install it with 'pip install tensorrt'.")
+
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, "rb") as f, trt.Runtime(logger) as runtime:
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        if self.engine is None:
+            raise RuntimeError(f"Error deserializing the TensorRT engine {engine_path}.")
+        self.context = self.engine.create_execution_context()
+
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        self.input_name = next(name for name in names if self.engine.get_tensor_mode(name) == trt.TensorIOMode.INPUT)
+        self.output_name = next(name for name in names if self.engine.get_tensor_mode(name) == trt.TensorIOMode.OUTPUT)
+        self.input_dtype = _TRT_TO_TORCH_DTYPES[self.engine.get_tensor_dtype(self.input_name).name]
+        output_dtype = _TRT_TO_TORCH_DTYPES[self.engine.get_tensor_dtype(self.output_name).name]
+        self.output = torch.empty(tuple(self.engine.get_tensor_shape(self.output_name)), dtype=output_dtype, device="cuda")
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.to(self.input_dtype).contiguous()
+        self.context.set_tensor_address(self.input_name, x.data_ptr())
+        self.context.set_tensor_address(self.output_name, self.output.data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+        return self.output.clone()
+
+class TRTImageEncoder(torch.nn.Module):
+    """
+        Stand-in for the SAM1 image encoder that runs a TensorRT engine. It only keeps img_size, which is all
+        Sam and SamPredictor read from the encoder, so the PyTorch encoder weights can be freed.
+    """
+    def __init__(self, runner: TRTRunner, img_size: int):
+        super().__init__()
+        self.runner = runner
+        self.img_size = img_size
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.runner(x)
+
 class PostProcessor:
     def __init__(self):
         pass
@@ -260,9 +436,11 @@ class PostProcessor:
     def postprocess_masks(self, masks: Union[torch.Tensor, List[torch.Tensor]], area_thresh: float) -> Union[torch.Tensor, List[torch.Tensor]]:
         def process_masks(mask_list: torch.Tensor, area_thresh: float, mode: str) -> torch.Tensor:
             """Apply remove_small_regions to a list of masks and return a stacked tensor."""
-            masks_np = [remove_small_regions(mask.squeeze().detach().cpu().numpy(), area_thresh, mode)[0] for mask in mask_list]
-            processed_masks = [np.expand_dims(mask, axis=0) for mask in masks_np]  # Add an extra dimension
-            return torch.stack([torch.from_numpy(mask) for mask in processed_masks], dim=0)
+            # Move the whole stack to host in a single transfer instead of one copy per mask
+            masks_host = mask_list.detach().cpu().numpy()
+            masks_np = [remove_small_regions(mask.squeeze(), area_thresh, mode)[0] for mask in masks_host]
+            processed_masks = np.stack(masks_np, axis=0)[:, None]  # Add an extra dimension
+            return torch.from_numpy(processed_masks)
         if isinstance(masks, list):
             processed_masks = []
             for mask_list in masks:
@@ -555,9 +733,11 @@ class PostProcessor2:
     def postprocess_masks(self, masks: Union[torch.Tensor, List[torch.Tensor]], area_thresh: float) -> Union[torch.Tensor, List[torch.Tensor]]:
         def process_masks(mask_list: torch.Tensor, area_thresh: float, mode: str) -> torch.Tensor:
             """Apply remove_small_regions to a list of masks and return a stacked tensor."""
-            masks_np = [remove_small_regions(mask.squeeze().detach().cpu().numpy(), area_thresh, mode)[0] for mask in mask_list]
-            processed_masks = [np.expand_dims(mask, axis=0) for mask in masks_np]  # Add an extra dimension
-            return torch.stack([torch.from_numpy(mask) for mask in processed_masks], dim=0)
+            # Move the whole stack to host in a single transfer instead of one copy per mask
+            masks_host = mask_list.detach().cpu().numpy()
+            masks_np = [remove_small_regions(mask.squeeze(), area_thresh, mode)[0] for mask in masks_host]
+            processed_masks = np.stack(masks_np, axis=0)[:, None]  # Add an extra dimension
+            return torch.from_numpy(processed_masks)
         if isinstance(masks, list):
             processed_masks = []
             for mask_list in masks:
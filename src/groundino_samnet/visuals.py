@@ -1,12 +1,19 @@
+import os
 import supervision as sv
 from groundingdino.util.inference import annotate
 import matplotlib.pyplot as plt
 import numpy as np
+import cv2
 from .utils import convert_image_to_numpy
 from typing import List, Tuple, Optional, Union
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 import torch
+from concurrent.futures import ThreadPoolExecutor
+
+def _annotate_one(args):
+  image, boxes, logits, phrases = args
+  return annotate(image_source=image, boxes=boxes, logits=logits, phrases=phrases)
 
 def plot_grid_dino(images,idss,boxes,logits,phrases,**args):
   imag_max = args.get("image_max",10) #cambiado, truncado de 20 a 10
@@ -18,11 +25,10 @@ def plot_grid_dino(images,idss,boxes,logits,phrases,**args):
     boxes = boxes[:imag_max]
     logits = logits[:imag_max]
     phrases = phrases[:imag_max]
-    images = [convert_image_to_numpy(image) for image in images]
-  annotated_frames = []
-  for i in range(len(boxes)):
-    annotated_frame = annotate(image_source=images[i], boxes=boxes[i], logits=logits[i], phrases=phrases[i])
-    annotated_frames.append(annotated_frame)
+  images = [convert_image_to_numpy(image) for image in images]
+  # Drawing is independent per image and cv2 releases the GIL; threads avoid re-importing torch in worker processes
+  with ThreadPoolExecutor(max_workers=max(1, min(len(images), os.cpu_count() or 1))) as executor:
+    annotated_frames = list(executor.map(_annotate_one, zip(images, boxes, logits, phrases)))
   plot_image_grid(
     images=annotated_frames,
     image_size=(20, 20),
@@ -81,22 +87,23 @@ def plot_image(image,boxes,logits,phrases):
 
 
 #Code from SAM2
-np.random.seed(3)
+_rng = np.random.default_rng(3)
 
 def show_mask(mask, ax, random_color=False, borders = True):
     if random_color:
-        color = np.concatenate([np.random.random(3), np.array([0.6])], axis=0)
+        color = np.concatenate([_rng.random(3, dtype=np.float32), np.array([0.6], dtype=np.float32)], axis=0)
     else:
-        color = np.array([30/255, 144/255, 255/255, 0.6])
+        color = np.array([30/255, 144/255, 255/255, 0.6], dtype=np.float32)
+    # Keep the RGBA overlay in uint8, imshow accepts it directly
+    color = (color * 255).astype(np.uint8)
     h, w = mask.shape[-2:]
-    mask = mask.astype(np.uint8)
+    mask = mask.astype(np.uint8, copy=False)
     mask_image =  mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
     if borders:
-        import cv2
         contours, _ = cv2.findContours(mask,cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE) 
         # Try to smooth contours
-        contours = [cv2.approxPolyDP(contour, epsilon=0.01, closed=True) for contour in contours]
-        mask_image = cv2.drawContours(mask_image, contours, -1, (1, 1, 1, 0.5), thickness=2) 
+        contours = [cv2.approxPolyDP(contour, epsilon=0.01 * cv2.arcLength(contour, True), closed=True) for contour in contours]
+        mask_image = cv2.drawContours(mask_image, contours, -1, (255, 255, 255, 128), thickness=2) 
     ax.imshow(mask_image)
 
 def show_points(coords, labels, ax, marker_size=375):